@@ -1,13 +1,67 @@
 import atexit
 import errno
-import inspect
+import fcntl
+import functools
 import os
 import os.path
+import string
 import sys
 import tempfile
-import urllib.parse
+import weakref
 import logging
 
+# Look the logger up once rather than going through the module-level
+# logging functions, which re-fetch the root logger on every call.
+_log = logging.getLogger(__name__)
+
+# Probe for /var/lock once at import so get_lock_file doesn't
+# stat it on every call.
+_VAR_LOCK_IS_DIR = os.path.isdir("/var/lock")
+
+# On Linux, if procfs is mounted, process liveness can be checked
+# with a single stat of /proc/<pid>. Probe once at import.
+_HAS_PROC = sys.platform.startswith("linux") and os.path.isdir("/proc")
+
+# Translation table used to sanitize lock names for use in file
+# names. Each unsafe byte becomes an underscore escape ("_" followed
+# by the byte's hex value) and a literal underscore becomes a doubled
+# underscore, so that distinct lock names can never map to the same
+# lockfile.
+_SANITIZE = {c: "_%02x" % c for c in range(256)
+             if chr(c) not in string.ascii_letters + string.digits + ".-"}
+_SANITIZE[ord("_")] = "__"
+
+# The current process's pid, pre-encoded for writing into lockfiles.
+# It is refreshed after a fork so a child that acquires a lock records
+# its own pid rather than its parent's.
+_MY_PID_BYTES = str(os.getpid()).encode("ascii")
+
+# The Locks currently held by this process, tracked so forked children
+# can disown them.
+_held_locks = weakref.WeakSet()
+
+def _after_fork_in_child():
+    global _MY_PID_BYTES
+    _MY_PID_BYTES = str(os.getpid()).encode("ascii")
+
+    # Locks held before the fork belong to the parent. Drop the
+    # child's inherited descriptors --- the parent's stay open, so
+    # the flocks survive; note we must not LOCK_UN here since the
+    # flock lives on the shared open file description --- and cancel
+    # any forever() cleanup hooks so the child can't release locks
+    # out from under the parent.
+    for lock in list(_held_locks):
+        if lock._fd is not None:
+            try:
+                os.close(lock._fd)
+            except OSError:
+                pass
+            lock._fd = None
+        atexit.unregister(lock.release)
+    _held_locks.clear()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 class CannotAcquireLock(Exception):
     pass
@@ -27,22 +81,51 @@ class Lock(object):
         with exit code 1."""
 
         if name is None:
-            # Use the name of the file containing the calling
-            # function.
-            name = os.path.abspath(inspect.stack()[1][1])
+            # The lock will be named for the file containing the
+            # calling function. Just grab the caller's filename here
+            # --- sys._getframe is much cheaper than inspect.stack(),
+            # which reads and parses source files for every frame on
+            # the stack just to get this one filename --- and defer
+            # the abspath call until the name is first needed.
+            self._caller_filename = sys._getframe(1).f_code.co_filename
 
-        self.name = name
+        self._name = name
         self.die = die
 
+        # The lockfile path is computed on first use and then cached
+        # so repeated acquisitions (e.g. through a decorated function)
+        # don't redo the sanitization and path assembly on every call.
+        self._lockfile = None
+
+        # The file descriptor holding the flock while the lock
+        # is acquired.
+        self._fd = None
+
         # Is this being used as a decorator? Yes if it's one
         # argument is a function.
         self.decorated_function = None
-        if len(args) == 1:
+        if args:
             if isinstance(args[0], str):
                 raise ValueError("Don't pass the lock name as a positional argument -- use the name keyword argument.")
             if callable(args[0]):
                 self.decorated_function = args[0]
 
+                # Take on the decorated function's name, docstring,
+                # etc. so the wrapped function introspects normally.
+                functools.update_wrapper(self, args[0])
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = os.path.abspath(self._caller_filename)
+        return self._name
+
+    @property
+    def lockfile(self):
+        if self._lockfile is None:
+            self._lockfile = get_lock_file(self.name)
+        return self._lockfile
+
     def __enter__(self):
         # Supports the "with" statement. The return value doesn't
         # matter since "with new Lock() as x" isn't really meaningful.
@@ -51,15 +134,18 @@ class Lock(object):
 
     def __exit__(self, *exc_info):
         # Called at the end of the "with" statement.
-        self._release()
+        self.release()
 
     def __call__(self, *args, **kwargs):
-        if self.decorated_function:
+        # Fetch the decorated function into a local up front so the
+        # common decorator case does a single attribute lookup.
+        decorated_function = self.decorated_function
+        if decorated_function:
             # The Lock instance was initialized with a callable,
             # which is how it's used as a decorator like @Lock.
             # Execute the decorated function inside a lock.
             with self:
-                return self.decorated_function(*args, **kwargs)
+                return decorated_function(*args, **kwargs)
         elif len(args) == 1 and callable(args[0]):
             # An instantiated Lock object can be applied to a
             # function so enable @Lock(name="abc") syntax. In
@@ -74,91 +160,115 @@ class Lock(object):
         # This method doesn't actually do anything except schedule
         # a cleanup routine that executes when the Python process
         # exits. If the Python process exits without the cleanup
-        # routine being excuted, that's totally fine, but it's
-        # nice to remove the lockfile.
+        # routine being excuted, that's totally fine --- the kernel
+        # drops the flock when the process goes away.
         self._acquire()
-        atexit.register(self._release)
+        atexit.register(self.release)
+
+    def try_acquire(self):
+        """Attempts to acquire the lock without blocking. Returns True
+           if the lock was acquired and False if another process is
+           holding it. Raises CannotAcquireLock if the lockfile itself
+           cannot be opened."""
+
+        # Open the lockfile, creating it if it doesn't yet exist, and
+        # take an exclusive flock on it. The flock is tied to the open
+        # file descriptor, so it is held until release closes the
+        # descriptor --- or the process exits, in which case the kernel
+        # releases it for us. Unlike a recorded pid, a flock can never
+        # go stale.
+        try:
+            # O_CLOEXEC so the descriptor (and with it the lock, if no
+            # forked holder remains) isn't leaked into exec'd programs.
+            fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        except OSError as e:
+            # There was a problem opening the lock file.
+            raise CannotAcquireLock("There was an error opening %s: %s." % (self.lockfile, str(e)))
+
+        try:
+            # Don't block: besides letting callers probe cheaply, flocks
+            # taken by separate descriptors conflict even within one
+            # process, so a blocking acquisition of an already-held name
+            # would wait on itself forever.
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        # We hold the lock. Record our pid in the lockfile so that
+        # other processes can report who is holding the lock. Write
+        # through the descriptor we already hold --- constructing a
+        # buffered text-mode file object just to emit a few ASCII
+        # digits would cost a codec lookup and a pile of allocations.
+        os.pwrite(fd, _MY_PID_BYTES, 0)
+        os.ftruncate(fd, len(_MY_PID_BYTES))
+
+        self._fd = fd
+        _held_locks.add(self)
+
+        # Log success. Can't do this before the flock since we expect
+        # it to fail sometimes.
+        _log.info("Acquired lock at %s...", self.lockfile)
+        return True
 
     def _acquire(self):
-        self.lockfile = get_lock_file(self.name)
-        my_pid = str(os.getpid())
+        if self.try_acquire():
+            return
 
-        # Write our process ID to the lockfile, if the lockfile doesn't
-        # yet exist.
+        # Another process is holding the lock. Read the pid recorded
+        # in the lockfile to make a helpful error message --- the
+        # flock itself is what guarantees exclusivity, so the pid is
+        # purely advisory and may be stale. The file holds at most a
+        # few ASCII digits, so one bounded read suffices; int()
+        # accepts bytes directly.
         try:
-            with open(self.lockfile, 'x') as f:
-                # Successfully opened a new file. Since the file is new
-                # there is no concurrent process. Write our pid. Lock
-                # first to prevent a race condition with the next block.
-                os.lockf(f.fileno(), os.F_LOCK, 0)
-                f.write(my_pid)
-
-        except FileExistsError:
-            # The lockfile already exists, or at least it did at the
-            # moment we tried to open it above. That probably indicates
-            # another process is running and is holding the lock.
-            #
-            # But it may contain a stale pid of a terminated process.
-            #
-            # And the file may have been deleted in a race condition.
-            # In that case, an OSError will probably be raised, which
-            # we'll re-wrap as a CannotAcquireLock.
-            #
-            # Open the lockfile in update ("r+") mode so we can check
-            # the PID inside it and, if the PID is stale, write ours
-            # to the file.
+            fd = os.open(self.lockfile, os.O_RDONLY)
             try:
-                with open(self.lockfile, 'r+') as f:
-                    # Get an exclusive lock. This blocks until a lock is acquired. The
-                    # lock is held until the flock file is closed at the end of the
-                    # with block.
-                    os.lockf(f.fileno(), os.F_LOCK, 0)
-
-                    # Read the pid in the file.
-                    try:
-                        existing_pid = int(f.read().strip())
-                    except ValueError:
-                        # The contents of the lockfile are not valid.
-                        pass
-                    else:
-                        # Check if the pid in it is valid, and if so, the
-                        # lock is held by another process and this Lock
-                        # cannot be created.
-                        if is_pid_valid(existing_pid):
-                            msg = "Another '%s' process is already running (pid %d)." % (self.name, existing_pid)
-                            if not self.die:
-                                raise CannotAcquireLock(msg)
-                            else:
-                                print(msg, file=sys.stderr)
-                                sys.exit(1)
-
-                    # The file didn't have a valid pid, so overwrite the file
-                    # with our pid.
-                    f.seek(0)
-                    f.write(my_pid)
-                    f.truncate()
-
-            except OSError as e:
-                # There was a problem opening the existing lock file.
-                raise CannotAcquireLock("There was an error opening %s after an open in 'x' mode failed, which might indicate the lock was held just moments ago: %s." % (self.lockfile, str(e)))
-
-        # Log success. Can't do this before the open since we expect
-        # it to fail sometimes.
-        logging.info("Acquired lock at " + self.lockfile + "...")
+                existing_pid = int(os.read(fd, 32))
+            finally:
+                os.close(fd)
+        except (OSError, ValueError):
+            existing_pid = None
+
+        if existing_pid is not None and is_pid_valid(existing_pid):
+            msg = "Another '%s' process is already running (pid %d)." % (self.name, existing_pid)
+        else:
+            msg = "Another '%s' process is already running." % self.name
+
+        if not self.die:
+            raise CannotAcquireLock(msg)
+        else:
+            print(msg, file=sys.stderr)
+            sys.exit(1)
 
 
-    def _release(self):
-        """Release the lock by deleting the lockfile."""
+    def release(self):
+        """Releases the lock, such as one taken with try_acquire.
+           Does nothing if the lock is not currently held.
+
+           The lock is released by dropping the flock and closing the
+           lockfile's file descriptor. The lockfile itself is left
+           behind: unlinking it would let a new acquirer create and
+           flock a fresh file while some other process still holds a
+           flock on the old one, and then both would believe they
+           hold the lock."""
+        if self._fd is None:
+            # Not currently held.
+            return
         try:
-            os.unlink(self.lockfile)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            _held_locks.discard(self)
 
             # Log success.
-            logging.info("Released lock at " + self.lockfile + "...")
+            _log.info("Released lock at %s...", self.lockfile)
         except:
             # Ignore all errors.
             pass
 
 
+@functools.lru_cache(maxsize=256)
 def get_lock_file(name):
     """Gets the file name to use to store the lock. If /var/lock is
        a directory, lock files are stored there. Otherwise they are
@@ -167,14 +277,17 @@ def get_lock_file(name):
        name, as it will be sanitized before being put into a file
        name."""
 
-    # Sanitize the global lock name by using URL-style quoting, which
-    # keeps most ASCII characters (nice) and turns the rest into ASCII.
-    name = urllib.parse.quote_plus(name)
+    # Sanitize the global lock name by keeping ASCII letters, digits,
+    # and ".-" (nice) and replacing the rest with underscore escapes.
+    # The escaping is one-to-one so that distinct names never share a
+    # lockfile, and str.translate with a precomputed table is a single
+    # C-level pass over the string.
+    name = name.translate(_SANITIZE)
 
     # Add a global thing for ourself.
     name = "py_exclusivelock_" + name
 
-    if os.path.isdir("/var/lock"):
+    if _VAR_LOCK_IS_DIR:
         return "/var/lock/%s.lock" % name
     return os.path.join(tempfile.gettempdir(), name + ".pid")
 
@@ -183,6 +296,15 @@ def is_pid_valid(pid):
     """Checks whether a pid is a valid process ID of a currently running process."""
     # adapted from http://stackoverflow.com/questions/568271/how-to-check-if-there-exists-a-process-with-a-given-pid
     if not isinstance(pid, int) or pid <= 0: raise ValueError('Invalid PID.')
+    if _HAS_PROC:
+        # A stat of /proc/<pid> answers definitively regardless of
+        # whether the process is owned by the current user, whereas
+        # the signal-based check below needs an EPERM special case.
+        try:
+            os.stat("/proc/%d" % pid)
+            return True
+        except FileNotFoundError:
+            return False
     try:
         os.kill(pid, 0)
     except OSError as err:
@@ -28,12 +28,16 @@ setup(
 		'Topic :: Software Development :: Libraries :: Python Modules',
 
 		'Programming Language :: Python :: 3',
-		'Programming Language :: Python :: 3.4',
-		'Programming Language :: Python :: 3.5',
-		'Programming Language :: Python :: 3.6',
+		'Programming Language :: Python :: 3.7',
+		'Programming Language :: Python :: 3.8',
+		'Programming Language :: Python :: 3.9',
+		'Programming Language :: Python :: 3.10',
+		'Programming Language :: Python :: 3.11',
 	],
 
 	keywords="exclusive process POSIX lock pid concurrent global system",
 
+	python_requires=">=3.7",
+
 	packages=find_packages(),
 )
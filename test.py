@@ -1,6 +1,8 @@
+import os
+
 # Log what happens so we can see that the locks are acquired and released.
 import logging
-logging.getLogger().setLevel('INFO')
+logging.basicConfig(level='INFO')
 
 # Begin tests...
 
@@ -38,6 +40,39 @@ def myfunc():
 myfunc()
 myfunc()
 
+# Try non-blocking acquisition with try_acquire.
+
+probe = Lock(name="test2")
+if not probe.try_acquire():
+	raise ValueError("should not get here")
+
+# While probe holds the lock, a second Lock on the same name
+# cannot take it.
+if Lock(name="test2").try_acquire():
+	raise ValueError("should not get here")
+
+# After release, the lock can be acquired again.
+probe.release()
+with Lock(name="test2"):
+	print("try_acquire returned False while the lock was held and True when free.")
+
+# Try forking while holding a lock. The child does not own the
+# inherited lock, and the parent still holds it after the child exits.
+
+with Lock(name="test3") as lock:
+	child_pid = os.fork()
+	if child_pid == 0:
+		# In the child: the inherited lock was disowned, and the lock
+		# cannot be re-acquired because the parent still holds it.
+		ok = (lock._fd is None) and not Lock(name="test3").try_acquire()
+		os._exit(0 if ok else 1)
+	if os.waitpid(child_pid, 0)[1] != 0:
+		raise ValueError("should not get here")
+	# In the parent: still holding the lock after the child exited.
+	if Lock(name="test3").try_acquire():
+		raise ValueError("should not get here")
+	print("The lock stayed with the parent across a fork.")
+
 # Try different lock names, and with forever().
 
 Lock(name="x").forever()